@@ -1,5 +1,17 @@
 #!/bin/sh
 
-lpstat -p | cut -d" " -f2 | xargs -I{} lpadmin -x {}
+# Remove queues in parallel with printercleanup.py when it's installed.
+# Jamf parameter 4, if set, is a pattern of queues to keep (e.g. "Library_*").
+CLEANUP="/Library/Application Support/UNCA/lib/printercleanup.py"
+if [ -f "$CLEANUP" ]; then
+    if [ -n "$4" ]; then
+        /usr/bin/python "$CLEANUP" --keep "$4"
+    else
+        /usr/bin/python "$CLEANUP"
+    fi
+else
+    # Only "printer NAME ..." lines name a queue; skip lpstat's status lines
+    lpstat -p | awk '/^printer /{print $2}' | xargs -I{} lpadmin -x {}
+fi
 
-exit 0
\ No newline at end of file
+exit 0
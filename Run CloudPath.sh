@@ -1,8 +1,18 @@
 #!/bin/sh
 
+# Time external commands through cmdrun.py when it's installed
+CMDRUN="/Library/Application Support/UNCA/lib/cmdrun.py"
+run() {
+    if [ -f "$CMDRUN" ]; then
+        /usr/bin/python "$CMDRUN" run -- "$@"
+    else
+        "$@"
+    fi
+}
+
 open /Users/Shared/Cloudpath/Cloudpath.app
 sleep 5
 
-networksetup -removepreferredwirelessnetwork en0 "Carroll WIFI"
+run networksetup -removepreferredwirelessnetwork en0 "Carroll WIFI"
 
 exit 0
\ No newline at end of file
@@ -8,19 +8,257 @@ Heavily cribbed from Jamf's iPhone ordering script:
 https://github.com/jamfit/iPhone-Ordering
 """
 
-import AppKit
+import time
+START = time.time()
+
 import sys
 import os
-import Tkinter
-import tkFont
-import tkMessageBox
-import subprocess
-import plistlib
+import threading
+import Queue
+
+# The GUI modules are only loaded once we know we're showing the GUI (see
+# import_gui()). AppKit, by far the slowest, waits until after the window
+# is drawn (see bring_to_front()); Foundation covers what's needed before.
+Foundation = Tkinter = tkFont = None
+
+# Path to Jamf binary (override with JAMF=... e.g. to use stubs/jamf)
+JAMF = os.environ.get("JAMF", "/usr/local/bin/jamf")
+
+# Deploy log + index of every CPU number assigned (see deploystate.py)
+DBPATH = os.environ.get("DEPLOY_DB", "/Library/Application Support/UNCA/db")
+
+# Kill jamf if it prints nothing for this many seconds
+PHASE_TIMEOUT = 600
+
+# reconbroker debounce for our recon; short, as someone is watching
+RECON_WINDOW = 1
+
+# Where the helper modules (bulkrename.py etc.) are installed
+LIBPATH = "/Library/Application Support/UNCA/lib"
+
+# Pre-decoded copy of mbp_icon (see icon_file()). Bump ICON_VERSION when
+# mbp_icon changes; Jamf rewrites this script for every run, so its own
+# mtime can't be used to tell.
+CACHEPATH = os.environ.get("ICON_CACHE", "/Library/Application Support/UNCA/cache")
+ICON_VERSION = 1
 
-# Path to Jamf binary
-JAMF = "/usr/local/bin/jamf"
+sys.path[:0] = [os.path.dirname(os.path.abspath(__file__)), LIBPATH]
+
+
+def helper(name):
+    """Path to one of the helper scripts, next to this one or in LIBPATH"""
+    for d in sys.path[:2]:
+        path = os.path.join(d, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def import_gui():
+    """Load the GUI modules; PyObjC is optional so this also runs under Xvfb"""
+    global Foundation, Tkinter, tkFont
+    import Tkinter
+    import tkFont
+    try:
+        import Foundation
+    except ImportError:
+        Foundation = None
+
+
+def bring_to_front():
+    """Activate the app over other windows; loads AppKit, so run after first draw"""
+    try:
+        import AppKit
+    except ImportError:
+        return
+    AppKit.NSApplication.sharedApplication().activateIgnoringOtherApps_(True)
+
+
+def gif_to_ppm(data, background):
+    """
+    Decode a GIF into a binary PPM, with transparent pixels painted in
+    background (an (r, g, b) tuple). Only the first frame is used.
+    """
+    data = bytearray(data)
+    width, height = data[6] | data[7] << 8, data[8] | data[9] << 8
+    pos = 13
+    palette = None
+    if data[10] & 0x80:
+        size = 3 << ((data[10] & 7) + 1)
+        palette = data[pos:pos + size]
+        pos += size
+    pixels = bytearray(bytes(bytearray(background)) * (width * height))
+    transparent = None
+
+    while pos < len(data):
+        block = data[pos]
+        if block == 0x21:
+            # Extension; only the graphic control one (transparency) matters
+            if data[pos + 1] == 0xF9 and data[pos + 3] & 1:
+                transparent = data[pos + 6]
+            pos += 2
+            while data[pos]:
+                pos += data[pos] + 1
+            pos += 1
+        elif block == 0x2C:
+            left, top = data[pos + 1] | data[pos + 2] << 8, data[pos + 3] | data[pos + 4] << 8
+            w, h = data[pos + 5] | data[pos + 6] << 8, data[pos + 7] | data[pos + 8] << 8
+            flags = data[pos + 9]
+            pos += 10
+            if flags & 0x80:
+                size = 3 << ((flags & 7) + 1)
+                palette = data[pos:pos + size]
+                pos += size
+            min_size = data[pos]
+            pos += 1
+            stream = bytearray()
+            while data[pos]:
+                stream += data[pos + 1:pos + 1 + data[pos]]
+                pos += data[pos] + 1
+
+            # LZW, codes packed least significant bit first
+            clear, end = 1 << min_size, (1 << min_size) + 1
+            indices = bytearray()
+            table = []
+            code_size = min_size + 1
+            prev = None
+            bits = nbits = 0
+            for byte in stream:
+                bits |= byte << nbits
+                nbits += 8
+                while nbits >= code_size:
+                    code = bits & ((1 << code_size) - 1)
+                    bits >>= code_size
+                    nbits -= code_size
+                    if code == clear:
+                        table = [bytearray([i]) for i in range(clear)] + [None, None]
+                        code_size = min_size + 1
+                        prev = None
+                        continue
+                    if code == end:
+                        nbits = -1
+                        break
+                    if prev is None:
+                        entry = table[code]
+                    elif code < len(table):
+                        entry = table[code]
+                        if len(table) < 4096:
+                            table.append(prev + entry[:1])
+                    else:
+                        entry = prev + prev[:1]
+                        table.append(entry)
+                    indices += entry
+                    prev = entry
+                    if len(table) == 1 << code_size and code_size < 12:
+                        code_size += 1
+                if nbits < 0:
+                    break
+
+            rows = list(range(h))
+            if flags & 0x40:
+                rows = (list(range(0, h, 8)) + list(range(4, h, 8)) +
+                        list(range(2, h, 4)) + list(range(1, h, 2)))
+            for n, y in enumerate(rows):
+                line = indices[n * w:(n + 1) * w]
+                for x, index in enumerate(line):
+                    if index == transparent or left + x >= width or top + y >= height:
+                        continue
+                    at = ((top + y) * width + left + x) * 3
+                    pixels[at:at + 3] = palette[index * 3:index * 3 + 3]
+            break
+        else:
+            break
+    return b'P6\n' + '{} {}\n255\n'.format(width, height).encode('ascii') + bytes(pixels)
+
+
+def icon_file(background=(0xF0, 0xF0, 0xF0)):
+    """
+    Path to mbp_icon as a PPM, decoded and written on first use
+
+    Tk reads a PPM straight into the photo without the GIF's LZW decode.
+    The name is keyed on ICON_VERSION and the size of mbp_icon, so a hit
+    costs one stat(). Returns None if there's nowhere to write it.
+    """
+    path = os.path.join(CACHEPATH, "mbp_icon-{}-{}.ppm".format(ICON_VERSION, len(mbp_icon)))
+    if os.path.isfile(path):
+        return path
+
+    import base64
+    import glob
+    try:
+        if not os.path.isdir(CACHEPATH):
+            os.makedirs(CACHEPATH)
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(gif_to_ppm(base64.b64decode(mbp_icon), background))
+        os.rename(tmp, path)
+        for stale in glob.glob(os.path.join(CACHEPATH, "mbp_icon-*")):
+            if stale != path:
+                os.remove(stale)
+    except (IOError, OSError, IndexError) as e:
+        print('Not caching icon: {}'.format(e))
+        return None
+    return path
+
+
+class Unchecked(Exception):
+    """Raised by validate() when the duplicate check couldn't be done"""
+
+
+def validate(i_computer, own_serial=None):
+    """
+    Check a CPU number before anything is run
+
+    Returns a message to show in the form, or None if it's good to use.
+    Duplicates are looked up in the cached fleet inventory (inventory.py);
+    a name already held by this very machine (own_serial) is fine. The
+    lookup only reads the cache, so this is safe on the Tk thread; raises
+    Unchecked if the cache can't be read.
+    """
+    if not i_computer:
+        return "Please enter the computer number."
+    if not i_computer.isdigit():
+        return "The computer number should only contain digits."
+    if len(i_computer) > 12:
+        return "That computer number is too long."
+
+    hostname = "cpu{}".format(i_computer)
+    try:
+        import inventory
+    except ImportError as e:
+        raise Unchecked(str(e))
+    try:
+        serial = inventory.Snapshot().owner(hostname)
+    except inventory.Unavailable as e:
+        raise Unchecked(str(e))
+    if serial is None:
+        return None
+
+    if serial and serial == own_serial:
+        return None
+    if serial:
+        return "{} is already in use by {}.".format(hostname, serial)
+    return "{} is already in use.".format(hostname)
+
+
+def own_serial():
+    """This machine's serial number, or None; forks ioreg, so not on the Tk thread"""
+    try:
+        import bulkrename
+        return bulkrename.local_identifiers()[0] or None
+    except Exception as e:
+        print('Could not read serial number: {}'.format(e))
+        return None
+
+
+def warm_inventory():
+    """Refresh the inventory cache in the background so checks are current"""
+    try:
+        import inventory
+        inventory.Snapshot().refresh()
+    except Exception as e:
+        print('Inventory refresh failed: {}'.format(e))
 
-PLISTPATH = "/Library/Application Support/UNCA/db/deploy.plist"
 
 # base64-encoded GIF for "icon" at the top of the GUI
 # MUST BE A GIF!
@@ -63,7 +301,11 @@ class App:
 
 
         # Get icon
-        self.icon_data = Tkinter.PhotoImage(data=mbp_icon)
+        path = icon_file(tuple(int(bgcolor[i:i + 2], 16) for i in (1, 3, 5)))
+        if path:
+            self.icon_data = Tkinter.PhotoImage(file=path)
+        else:
+            self.icon_data = Tkinter.PhotoImage(data=mbp_icon)
 
         # Icon Frame
         self.frame1 = Tkinter.Frame(self.master)
@@ -83,24 +325,72 @@ class App:
                                                  background='white',
                                                  textvariable=self.input_assigned_computer,
                                                  width=30)
-        self.entry_assigned_computer.pack(pady=(0, 20))
+        self.entry_assigned_computer.pack(pady=(0, 5))
+
+        # Problems with the input are shown here rather than exiting
+        self.error = Tkinter.StringVar()
+        error_label = Tkinter.Label(self.frame3, textvariable=self.error,
+                                    foreground='red')
+        error_label.pack(pady=(0, 10))
 
 
         self.frame3.pack(padx=40, pady=5)
 
+        # Progress frame
+        self.status = Tkinter.StringVar()
+        self.frame4 = Tkinter.Frame(self.master)
+        status_label = Tkinter.Label(self.frame4, textvariable=self.status)
+        status_label.pack()
+        self.frame4.pack(padx=40)
+
         # Buttons
         self.frame5 = Tkinter.Frame(self.master)
-        submit = Tkinter.Button(self.frame5, text='Assign', height=1, width=8, command=self.submit)
-        submit.pack(side='right')
+        self.submit_button = Tkinter.Button(self.frame5, text='Assign', height=1, width=8, command=self.submit)
+        self.submit_button.pack(side='right')
         cancel = Tkinter.Button(self.frame5, text='Cancel', height=1, width=8, command=self.cancel)
         cancel.pack(side='right')
         self.frame5.pack(padx=40, pady=(5, 30))
 
         # Add GUI padding
 
+        # Background job state: the worker thread posts (kind, message)
+        # tuples to self.events and poll() picks them up on the Tk thread
+        self.events = Queue.Queue()
+        self.worker = None
+        self.stream = None
+        self.hostname = None
+        self.step = None
+        self.proc_lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.exit_code = 0
+
+        # Filled in by prepare(); a number the tech chose to use unchecked
+        self.serial = None
+        self.unchecked = None
+        background = threading.Thread(target=self.prepare)
+        background.daemon = True
+        background.start()
+
+    def prepare(self):
+        """Slow lookups validate() needs, done off the Tk thread"""
+        self.serial = own_serial()
+        warm_inventory()
+
     def cancel(self):
-        """Exit the GUI"""
+        """Exit the GUI, killing any jamf command that is still running"""
         print('User has closed the app')
+        if self.worker is not None and self.worker.is_alive():
+            self.cancelled.set()
+            with self.proc_lock:
+                if self.stream is not None and self.stream.proc.poll() is None:
+                    print('Killing {}'.format(self.stream.pid))
+                    # The child leads its own process group, so this also
+                    # takes out jamf when it's running under reconbroker;
+                    # kill() ignores a child the worker has already reaped
+                    self.stream.kill()
+            # The worker records the cancellation (see run_jamf()), so
+            # the window closes without waiting on the deploy log
+            self.exit_code = 1
         self.master.destroy()
 
     def submit(self):
@@ -115,6 +405,8 @@ class App:
         """
         print('User has submitted')
 
+        if self.worker is not None and self.worker.is_alive():
+            return
 
         # Splitting each character of the input with split(), then re-joining
         # with ''.join() strips all whitespace as opposed to strip() which
@@ -122,50 +414,199 @@ class App:
 
         i_computer = ''.join(self.input_assigned_computer.get().split())
 
+        # Allow for the tech typing the "CPU" off the sticker as well
+        if i_computer.lower().startswith('cpu'):
+            i_computer = i_computer[3:]
+
+        try:
+            problem = validate(i_computer, self.serial)
+        except Unchecked as e:
+            print('Inventory check failed: {}'.format(e))
+            problem = None
+            if self.unchecked != i_computer:
+                # Warn once; pressing Assign again with the same number
+                # goes ahead without the check
+                self.unchecked = i_computer
+                problem = ("Couldn't check whether cpu{} is already in use.\n"
+                           "Press Assign again to use it anyway.".format(i_computer))
+        if problem:
+            print(problem)
+            self.error.set(problem)
+            self.entry_assigned_computer.focus_set()
+            return
+        self.error.set('')
 
         # Assemble hostname
         hostname = "cpu{}".format(i_computer)
 
         print "Hostname: {}".format(hostname)
 
-        # Rename the computer
-        cmd = [JAMF, 'setComputerName', '-name', hostname]
-        rename = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE)
-        (out, err) = rename.communicate()
-        if rename.returncode == 0:
-            print "Set computer name to {}".format(hostname)
+        # Run jamf off the Tk thread so the window stays responsive
+        self.submit_button.config(state='disabled')
+        self.entry_assigned_computer.config(state='disabled')
+        self.hostname = hostname
+        self.worker = threading.Thread(target=self.run_jamf, args=(hostname,))
+        self.worker.daemon = True
+        self.worker.start()
+        self.master.after(100, self.poll)
+
+    def run_jamf(self, hostname):
+        """Rename and recon in the background; runs on the worker thread"""
+        import cmdstream
+
+        # Go through the broker so this recon coalesces with any others
+        # that policies in the same chain ask for
+        broker = helper('reconbroker.py')
+        if broker:
+            recon = [sys.executable, broker, '--window', str(RECON_WINDOW)]
+            labels = {'recon': 'reconbroker'}
+            # Queueing behind another policy's recon isn't a stall; the
+            # broker prints this while it waits (reconbroker.WAITING)
+            timeouts = {'recon': {'Waiting for the recon lock': 0}}
         else:
-            print "Rename failed!"
-            sys.exit(1)
-
-        # Submit new inventory
-        cmd = [JAMF, 'recon']
-        inventory = subprocess.Popen(cmd, stdout=subprocess.PIPE,
-                                     stderr=subprocess.PIPE)
-        (out, err) = inventory.communicate()
-        if inventory.returncode == 0:
-            print "Submitted inventory to JSS"
-        else:
-            print "Inventory update failed!"
-            sys.exit(1)
-
-        self.master.destroy()
+            recon = [JAMF, 'recon']
+            labels = {}
+            timeouts = {}
+
+        steps = [('rename',
+                  [JAMF, 'setComputerName', '-name', hostname],
+                  "Setting computer name to {}...".format(hostname),
+                  "Set computer name to {}".format(hostname),
+                  "Rename failed!"),
+                 ('recon',
+                  recon,
+                  "Submitting inventory to JSS...",
+                  "Submitted inventory to JSS",
+                  "Inventory update failed!")]
+
+        for step, cmd, running, success, failure in steps:
+            if self.cancelled.is_set():
+                return
+            self.step = step
+            # Deploy log writes (fsync + SQLite) stay outside proc_lock,
+            # which cancel() takes on the Tk thread
+            self.record(step, 'started')
+            stream = None
+            try:
+                with self.proc_lock:
+                    # Checked under the lock: either cancel() sees this
+                    # stream and kills it, or we see the cancellation
+                    if not self.cancelled.is_set():
+                        # Output is streamed (only the tail is kept) and
+                        # the step's timing is logged through cmdrun
+                        stream = cmdstream.Stream(cmd, phase_timeout=PHASE_TIMEOUT,
+                                                  timeouts=timeouts.get(step),
+                                                  label=labels.get(step),
+                                                  new_group=True)
+                        self.stream = stream
+            except OSError as e:
+                self.record(step, 'failed', str(e))
+                self.events.put(('error', "{} ({})".format(failure, e)))
+                return
+            if stream is not None:
+                self.events.put(('progress', running))
+                for kind, value in stream.events():
+                    if kind == 'phase':
+                        self.events.put(('progress', "{} {}".format(running, value)))
+            if self.cancelled.is_set():
+                self.record(step, 'cancelled')
+                return
+            if stream.returncode == 0:
+                self.record(step, 'ok')
+                self.events.put(('progress', success))
+            else:
+                if stream.stalled:
+                    failure = "{} No output during \"{}\" for {} seconds.".format(
+                        failure, stream.phase, PHASE_TIMEOUT)
+                self.record(step, 'failed', '\n'.join(stream.tail))
+                self.events.put(('error', failure))
+                return
+
+        self.events.put(('done', None))
+
+    def record(self, step, status, detail=''):
+        """Note a step in the deploy log; a logging problem never stops the rename"""
+        try:
+            import deploystate
+            deploystate.Store(DBPATH).record(self.hostname, step, status,
+                                             hostname=self.hostname,
+                                             detail=detail)
+        except Exception as e:
+            print('Could not record {} {}: {}'.format(step, status, e))
+
+    def poll(self):
+        """Apply progress posted by the worker; reschedules itself"""
+        try:
+            while True:
+                kind, message = self.events.get_nowait()
+                if kind == 'done':
+                    self.master.destroy()
+                    return
+                print(message)
+                self.status.set(message)
+                if kind == 'error':
+                    self.exit_code = 1
+                    import tkMessageBox
+                    tkMessageBox.showerror("Assign CPU Number", message)
+                    self.master.destroy()
+                    return
+        except Queue.Empty:
+            pass
+        self.master.after(100, self.poll)
+
+
+def headless(manifest, options):
+    """
+    Rename from a manifest instead of prompting (see bulkrename.py)
+
+    Run from a Jamf policy with parameter 4 set to the manifest path.
+    Parameter 5 holds extra bulkrename options. Unless they include
+    --wrapper, --local is added, i.e. look up this machine's own
+    serial/MAC in the manifest.
+    """
+    import bulkrename
+    import shlex
+    bulkrename.JAMF = JAMF
+    args = shlex.split(options)
+    if not any(arg == '--local' or arg.startswith('--wrapper') for arg in args):
+        args.append('--local')
+    sys.exit(bulkrename.main([manifest] + args))
 
 
 def main():
+    # Jamf passes mount point, computer name and username as $1-$3;
+    # a manifest in $4 means run without the GUI
+    if len(sys.argv) > 4 and sys.argv[4].strip():
+        headless(sys.argv[4].strip(), ' '.join(sys.argv[5:6]))
+
+    import_gui()
+
     # Prevent the Python app icon from appearing in the Dock
-    info = AppKit.NSBundle.mainBundle().infoDictionary()
-    info['CFBundleIconFile'] = u'PythonApplet.icns'
-    info['LSUIElement'] = True
+    if Foundation:
+        info = Foundation.NSBundle.mainBundle().infoDictionary()
+        info['CFBundleIconFile'] = u'PythonApplet.icns'
+        info['LSUIElement'] = True
 
     root = Tkinter.Tk()
     app = App(root)
-    # Have the GUI appear on top of all other windows
-    AppKit.NSApplication.sharedApplication().activateIgnoringOtherApps_(True)
+    if os.environ.get('STARTUP_BENCHMARK'):
+        # Report time to first draw for benchmarks/startup.py, then quit
+        root.wait_visibility()
+        root.update()
+        print('startup_ms: {:.1f}'.format((time.time() - START) * 1000))
+        sys.exit(0)
+
+    # Have the GUI appear on top of all other windows, once it's up
+    root.after_idle(bring_to_front)
+
     rdata = app.master.mainloop()
 
-    sys.exit(0)
+    # After a Cancel the worker is still noting it in the deploy log;
+    # the window is already gone, so give it a moment to finish
+    if app.worker is not None:
+        app.worker.join(10)
+
+    sys.exit(app.exit_code)
 
 if __name__ == '__main__':
     main()
@@ -1,21 +1,43 @@
 #!/bin/sh
+# Time external commands through cmdrun.py when it's installed
+CMDRUN="/Library/Application Support/UNCA/lib/cmdrun.py"
+run() {
+    if [ -f "$CMDRUN" ]; then
+        /usr/bin/python "$CMDRUN" run -- "$@"
+    else
+        "$@"
+    fi
+}
+
 # Get current user and OS information.
 sleep 2
-CURRENT_USER=`python -c 'from SystemConfiguration import SCDynamicStoreCopyConsoleUser; import sys; username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]; username = [username,""][username in [u"loginwindow", None, u""]]; sys.stdout.write(username + "\n");'`
-USER_ID=$(id -u "$CURRENT_USER")
-OS_MAJOR=$(/usr/bin/sw_vers -productVersion | awk -F . '{print $1}')
-OS_MINOR=$(/usr/bin/sw_vers -productVersion | awk -F . '{print $2}')
+SESSIONCTX="/Library/Application Support/UNCA/lib/sessionctx.py"
+if [ -f "$SESSIONCTX" ]; then
+    # One cached probe instead of a python, id, two sw_vers and two awk
+    eval "$(/usr/bin/python -S "$SESSIONCTX" --shell)"
+else
+    CURRENT_USER=`python -c 'from SystemConfiguration import SCDynamicStoreCopyConsoleUser; import sys; username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]; username = [username,""][username in [u"loginwindow", None, u""]]; sys.stdout.write(username + "\n");'`
+    USER_ID=$(id -u "$CURRENT_USER")
+    OS_MAJOR=$(/usr/bin/sw_vers -productVersion | awk -F . '{print $1}')
+    OS_MINOR=$(/usr/bin/sw_vers -productVersion | awk -F . '{print $2}')
+fi
 
 # Launching NoMAD using launchctl.
 echo "Launching NoMAD..."
 if [[ "$OS_MAJOR" -eq 10 && "$OS_MINOR" -le 9 ]]; then
     LOGINWINDOW_PID=$(pgrep -x -u "$USER_ID" loginwindow)
-    /bin/launchctl bsexec "$LOGINWINDOW_PID" /bin/launchctl load /Library/LaunchAgents/com.trusourcelabs.NoMAD.plist
+    run /bin/launchctl bsexec "$LOGINWINDOW_PID" /bin/launchctl load /Library/LaunchAgents/com.trusourcelabs.NoMAD.plist
 elif [[ "$OS_MAJOR" -eq 10 && "$OS_MINOR" -gt 9 ]]; then
-    /bin/launchctl asuser "$USER_ID" /bin/launchctl load /Library/LaunchAgents/com.trusourcelabs.NoMAD.plist
+    run /bin/launchctl asuser "$USER_ID" /bin/launchctl load /Library/LaunchAgents/com.trusourcelabs.NoMAD.plist
 else
     echo "[ERROR] macOS $OS_MAJOR.$OS_MINOR is not supported."
     exit 1004
 fi
 
-sudo jamf recon
\ No newline at end of file
+# Let the recon broker fold this into any other recon the policy chain runs
+RECON_BROKER="/Library/Application Support/UNCA/lib/reconbroker.py"
+if [ -f "$RECON_BROKER" ]; then
+    /usr/bin/python "$RECON_BROKER" --no-wait
+else
+    run sudo jamf recon
+fi
\ No newline at end of file
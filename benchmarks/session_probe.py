@@ -0,0 +1,130 @@
+#!/usr/bin/python
+"""
+Session probe benchmark
+
+Times the way "Setup and Start NoMAD.sh" used to work out the console
+user and OS version (a Python process importing SystemConfiguration, then
+id, two sw_vers and two awk) against one `eval "$(sessionctx.py --shell)"`,
+with the cache both cold and warm.
+
+The macOS probes are stubbed so this runs on Linux: a SystemConfiguration
+module and sw_vers for the old chain, a fake SystemVersion.plist and
+console device for sessionctx. The stub SystemConfiguration imports
+instantly, where the real PyObjC bridge takes a good fraction of a
+second, so the old chain's numbers here are a lower bound.
+
+    python benchmarks/session_probe.py --python python2 -n 20
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import pwd
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SESSIONCTX = os.path.join(HERE, os.pardir, 'sessionctx.py')
+
+# The probes from "Setup and Start NoMAD.sh" before sessionctx.py, with
+# the interpreter and sw_vers swapped for $PYTHON and $SW_VERS
+OLD_CHAIN = r'''
+CURRENT_USER=`"$PYTHON" -c 'from SystemConfiguration import SCDynamicStoreCopyConsoleUser; import sys; username = (SCDynamicStoreCopyConsoleUser(None, None, None) or [None])[0]; username = [username,""][username in [u"loginwindow", None, u""]]; sys.stdout.write(username + "\n");'`
+USER_ID=$(id -u "$CURRENT_USER")
+OS_MAJOR=$("$SW_VERS" -productVersion | awk -F . '{print $1}')
+OS_MINOR=$("$SW_VERS" -productVersion | awk -F . '{print $2}')
+echo "$CURRENT_USER $USER_ID $OS_MAJOR.$OS_MINOR"
+'''
+
+NEW_CHAIN = r'''
+eval "$("$PYTHON" -S "$SESSIONCTX" $FLAGS --shell)"
+echo "$CURRENT_USER $USER_ID $OS_MAJOR.$OS_MINOR"
+'''
+
+SYSTEM_VERSION = '''<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE plist PUBLIC "-//Apple//DTD PLIST 1.0//EN" "http://www.apple.com/DTDs/PropertyList-1.0.dtd">
+<plist version="1.0">
+<dict>
+	<key>ProductBuildVersion</key>
+	<string>16G29</string>
+	<key>ProductName</key>
+	<string>Mac OS X</string>
+	<key>ProductVersion</key>
+	<string>10.12.6</string>
+</dict>
+</plist>
+'''
+
+
+def make_stubs(root, user):
+    """Write the stand-in macOS probes into root; returns extra env"""
+    with open(os.path.join(root, 'SystemConfiguration.py'), 'w') as f:
+        f.write("def SCDynamicStoreCopyConsoleUser(store, uid, gid):\n"
+                "    return ({!r}, 0, 0)\n".format(user))
+    sw_vers = os.path.join(root, 'sw_vers')
+    with open(sw_vers, 'w') as f:
+        f.write("#!/bin/sh\necho 10.12.6\n")
+    os.chmod(sw_vers, 0o755)
+    plist = os.path.join(root, 'SystemVersion.plist')
+    with open(plist, 'w') as f:
+        f.write(SYSTEM_VERSION)
+    console = os.path.join(root, 'console')
+    open(console, 'w').close()
+    try:
+        entry = pwd.getpwnam(user)
+        os.chown(console, entry.pw_uid, entry.pw_gid)
+    except (KeyError, OSError):
+        pass
+    return {'PYTHONPATH': root, 'SW_VERS': sw_vers, 'SESSIONCTX': SESSIONCTX,
+            'SESSIONCTX_CONSOLE': console, 'SESSIONCTX_SYSTEM_VERSION': plist,
+            'SESSIONCTX_CACHE': os.path.join(root, 'session.ctx')}
+
+
+def time_script(script, env, runs):
+    """Milliseconds for each of runs executions of script under sh"""
+    times = []
+    out = ''
+    for _ in range(runs):
+        start = time.time()
+        proc = subprocess.Popen(['/bin/sh', '-c', script], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        out = proc.communicate()[0].decode('utf-8', 'replace').strip()
+        times.append((time.time() - start) * 1000)
+        if proc.returncode != 0:
+            raise RuntimeError("script failed:\n{}".format(out))
+    return sorted(times), out
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare session probe chains")
+    parser.add_argument('-n', '--runs', type=int, default=20,
+                        help="runs of each chain (default %(default)s)")
+    parser.add_argument('--python', default=sys.executable,
+                        help="interpreter for both chains (default: this one)")
+    parser.add_argument('--user', default=os.environ.get('USER') or 'nobody',
+                        help="console user the stubs report (default %(default)s)")
+    args = parser.parse_args(argv)
+
+    root = tempfile.mkdtemp(prefix='session-probe-')
+    try:
+        env = dict(os.environ, PYTHON=args.python, **make_stubs(root, args.user))
+        results = [('old chain', time_script(OLD_CHAIN, env, args.runs)),
+                   ('sessionctx cold', time_script(
+                       NEW_CHAIN, dict(env, FLAGS='--refresh'), args.runs)),
+                   ('sessionctx warm', time_script(NEW_CHAIN, env, args.runs))]
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+    baseline = results[0][1][0][len(results[0][1][0]) // 2]
+    for label, (times, out) in results:
+        median = times[len(times) // 2]
+        print("{:<16} min {:7.1f}  median {:7.1f}  max {:7.1f} ms  ({:.1f}x)  -> {}".format(
+            label, times[0], median, times[-1], baseline / median, out))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+"""
+Startup benchmark for "Set CPU Number.py"
+
+Launches the prompt repeatedly with STARTUP_BENCHMARK=1, which makes it
+quit as soon as its window has been drawn, and reports how long that took
+both from the outside (process start to exit) and as measured by the
+script itself (module import to first draw). The first run uses an empty
+icon cache; the rest hit the cache.
+
+Works anywhere Tk can open a window, e.g. on Linux:
+
+    xvfb-run -a python benchmarks/startup.py --python python2 --max-ms 800
+
+Exits 1 if the median warm startup goes over --max-ms.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                      os.pardir, 'Set CPU Number.py')
+
+
+def launch(python, env):
+    """Run the prompt once; returns (wall ms, in-process ms)"""
+    start = time.time()
+    proc = subprocess.Popen([python, SCRIPT], stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT, env=env)
+    out = proc.communicate()[0].decode('utf-8', 'replace')
+    wall = (time.time() - start) * 1000
+    if proc.returncode != 0:
+        raise RuntimeError("prompt exited {}:\n{}".format(proc.returncode, out))
+    for line in out.splitlines():
+        if line.startswith('startup_ms:'):
+            return wall, float(line.split(':', 1)[1])
+    raise RuntimeError("no startup_ms in output:\n{}".format(out))
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the CPU-number prompt's startup")
+    parser.add_argument('-n', '--runs', type=int, default=10,
+                        help="warm runs to time (default %(default)s)")
+    parser.add_argument('--python', default='python2',
+                        help="interpreter to run the prompt with (default %(default)s)")
+    parser.add_argument('--max-ms', type=float,
+                        help="fail if the median warm startup is slower than this")
+    args = parser.parse_args(argv)
+
+    cache = tempfile.mkdtemp(prefix='icon-cache-')
+    env = dict(os.environ, STARTUP_BENCHMARK='1', ICON_CACHE=cache)
+    try:
+        cold = launch(args.python, env)
+        warm = [launch(args.python, env) for _ in range(args.runs)]
+    finally:
+        shutil.rmtree(cache, ignore_errors=True)
+
+    print("cold:  wall {:7.1f} ms   first draw {:7.1f} ms".format(*cold))
+    for label, index in (('wall', 0), ('first draw', 1)):
+        values = [run[index] for run in warm]
+        print("warm {:<10} min {:7.1f}  median {:7.1f}  max {:7.1f} ms".format(
+            label, min(values), median(values), max(values)))
+
+    if args.max_ms is not None:
+        slow = median([run[1] for run in warm])
+        if slow > args.max_ms:
+            print("FAIL: median startup {:.1f} ms > {:.1f} ms".format(slow, args.max_ms))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
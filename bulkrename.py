@@ -0,0 +1,398 @@
+#!/usr/bin/python
+"""
+Bulk Rename
+
+Headless counterpart to "Set CPU Number.py" for reimaging a whole lab at
+once. Reads a manifest mapping serial numbers or MAC addresses to CPU
+numbers, then runs `jamf setComputerName` and `jamf recon` for each entry
+through a bounded pool of workers, retrying and timing out per job, and
+writes a results report.
+
+Manifests are either CSV with a header row:
+
+    serial,mac,cpu
+    C02XK1ABJGH5,,1234
+    ,a4:83:e7:01:02:03,1235
+
+or JSON, as a list of objects with the same keys or as a plain mapping of
+serial/MAC to CPU number:
+
+    {"C02XK1ABJGH5": "1234", "a4:83:e7:01:02:03": "1235"}
+
+Say where the commands run with exactly one of:
+
+    --wrapper "ssh admin@{serial}.lab"   push them out to each machine (the
+                                         template is filled in from its row)
+    --local                              only process the row that matches
+                                         this machine's serial/MAC
+
+Without either, every row would rename the machine running this, so
+bulkrename.py refuses to start.
+
+The report goes to REPORT unless --report says otherwise.
+
+Set JAMF in the environment to use a different jamf binary, e.g. the stub
+in stubs/jamf for benchmarking throughput on Linux.
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import json
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import cmdrun
+
+# Path to Jamf binary
+JAMF = os.environ.get("JAMF", "/usr/local/bin/jamf")
+
+# Default results report; policies run with / as the working directory
+REPORT = os.environ.get("BULKRENAME_REPORT",
+                        "/Library/Application Support/UNCA/logs/bulkrename-report.json")
+
+MAC_RE = re.compile(r'^([0-9a-f]{2}[:-]?){5}[0-9a-f]{2}$')
+
+
+class ManifestError(Exception):
+    """Raised when a manifest can't be read or has a bad row"""
+
+
+class Job(object):
+    """One machine to rename, and the result of doing so"""
+
+    def __init__(self, cpu, serial='', mac=''):
+        self.cpu = cpu
+        self.serial = serial
+        self.mac = mac
+        self.hostname = "cpu{}".format(cpu)
+        self.status = 'pending'
+        self.attempts = 0
+        self.rename_rc = None
+        self.recon_rc = None
+        self.duration = 0.0
+        self.error = ''
+
+    @property
+    def key(self):
+        return self.serial or self.mac
+
+    def fields(self):
+        """Values available to --wrapper templates"""
+        return {'cpu': self.cpu, 'serial': self.serial, 'mac': self.mac,
+                'hostname': self.hostname, 'key': self.key}
+
+    def as_dict(self):
+        return {'key': self.key, 'serial': self.serial, 'mac': self.mac,
+                'cpu': self.cpu, 'hostname': self.hostname,
+                'status': self.status, 'attempts': self.attempts,
+                'rename_rc': self.rename_rc, 'recon_rc': self.recon_rc,
+                'duration': round(self.duration, 3), 'error': self.error}
+
+
+REPORT_FIELDS = ['key', 'serial', 'mac', 'cpu', 'hostname', 'status',
+                 'attempts', 'rename_rc', 'recon_rc', 'duration', 'error']
+
+
+def normalize_mac(mac):
+    """Lower-case, colon-separated form of a MAC address"""
+    digits = re.sub(r'[^0-9a-f]', '', mac.lower())
+    return ':'.join(digits[i:i + 2] for i in range(0, len(digits), 2))
+
+
+def make_job(row, where):
+    """Build a Job from a manifest row (a dict with serial/mac/cpu keys)"""
+    if not isinstance(row, dict):
+        raise ManifestError("{}: expected an object, got {!r}".format(where, row))
+    cpu = ''.join(str(row.get('cpu') or '').split())
+    serial = str(row.get('serial') or '').strip().upper()
+    mac = str(row.get('mac') or '').strip()
+    if not cpu.isdigit():
+        raise ManifestError("{}: bad CPU number {!r}".format(where, cpu))
+    if mac:
+        if not MAC_RE.match(mac.lower()):
+            raise ManifestError("{}: bad MAC address {!r}".format(where, mac))
+        mac = normalize_mac(mac)
+    if not serial and not mac:
+        raise ManifestError("{}: needs a serial or MAC".format(where))
+    return Job(cpu, serial=serial, mac=mac)
+
+
+def read_manifest(path):
+    """Load a CSV or JSON manifest into a list of Jobs"""
+    if path.lower().endswith('.json'):
+        with open(path) as f:
+            try:
+                data = json.load(f)
+            except ValueError as e:
+                raise ManifestError("{}: {}".format(path, e))
+        if isinstance(data, dict):
+            rows = []
+            for ident, cpu in sorted(data.items()):
+                if MAC_RE.match(ident.lower()):
+                    rows.append({'mac': ident, 'cpu': cpu})
+                else:
+                    rows.append({'serial': ident, 'cpu': cpu})
+        elif isinstance(data, list):
+            rows = data
+        else:
+            raise ManifestError("{}: expected a list or an object".format(path))
+        jobs = [make_job(row, "{} entry {}".format(path, n))
+                for n, row in enumerate(rows, 1)]
+    else:
+        if sys.version_info[0] < 3:
+            f = open(path, 'rb')
+        else:
+            f = open(path, newline='')
+        with f:
+            reader = csv.DictReader(f)
+            jobs = []
+            for row in reader:
+                row = dict((k.strip().lower(), v) for k, v in row.items() if k)
+                if not any(row.values()):
+                    continue
+                jobs.append(make_job(row, "{} line {}".format(path, reader.line_num)))
+
+    seen = {}
+    for job in jobs:
+        for taken in (job.key, job.hostname):
+            if taken in seen:
+                raise ManifestError("{} appears twice in {}".format(taken, path))
+            seen[taken] = job
+    return jobs
+
+
+class BulkRenamer(object):
+    """Run rename + recon for a list of Jobs through a bounded worker pool"""
+
+    def __init__(self, jobs, workers=8, retries=2, timeout=300, wrapper=None,
+                 recon=True, retry_delay=1.0):
+        self.jobs = jobs
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.timeout = timeout
+        self.wrapper = wrapper
+        self.recon = recon
+        self.retry_delay = retry_delay
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def command(self, job, args):
+        cmd = [JAMF] + args
+        if self.wrapper:
+            prefix = [part.format(**job.fields()) for part in shlex.split(self.wrapper)]
+            cmd = prefix + cmd
+        return cmd
+
+    def attempt(self, job):
+        """One try at renaming (and reconning) job. True on success."""
+        result = cmdrun.run(
+            self.command(job, ['setComputerName', '-name', job.hostname]),
+            self.timeout, label='jamf setComputerName')
+        job.rename_rc = result.returncode
+        if result.returncode != 0:
+            job.error = self.describe('rename', result)
+            return False
+
+        if self.recon:
+            result = cmdrun.run(self.command(job, ['recon']), self.timeout,
+                                label='jamf recon')
+            job.recon_rc = result.returncode
+            if result.returncode != 0:
+                job.error = self.describe('recon', result)
+                return False
+
+        job.error = ''
+        return True
+
+    def describe(self, step, result):
+        if result.timed_out:
+            return "{} timed out after {}s".format(step, self.timeout)
+        err = result.err
+        if isinstance(err, bytes):
+            err = err.decode('utf-8', 'replace')
+        return "{} failed: {}".format(step, (err or '').strip()[-200:])
+
+    def process(self, job):
+        start = time.time()
+        for n in range(1, self.retries + 2):
+            job.attempts = n
+            try:
+                ok = self.attempt(job)
+            except OSError as e:
+                job.error = str(e)
+                ok = False
+            except Exception as e:
+                # Anything else would kill this worker and leave the job
+                # (and the rest of its queue) 'pending' in the report
+                job.error = "{}: {}".format(type(e).__name__, e)
+                job.status = 'failed'
+                break
+            if ok:
+                job.status = 'ok'
+                break
+            job.status = 'failed'
+            if n <= self.retries:
+                time.sleep(self.retry_delay)
+        job.duration = time.time() - start
+        with self._lock:
+            print("{:<8} {:<20} {} ({} attempt(s), {:.2f}s){}".format(
+                job.status, job.key, job.hostname, job.attempts, job.duration,
+                ": " + job.error if job.error else ''))
+
+    def worker(self, pending):
+        while True:
+            try:
+                job = pending.get_nowait()
+            except queue.Empty:
+                return
+            self.process(job)
+
+    def run(self):
+        pending = queue.Queue()
+        for job in self.jobs:
+            pending.put(job)
+
+        start = time.time()
+        threads = [threading.Thread(target=self.worker, args=(pending,))
+                   for _ in range(min(self.workers, len(self.jobs)))]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            # join() with a timeout keeps Ctrl-C working in Python 2
+            while t.is_alive():
+                t.join(0.5)
+        self.elapsed = time.time() - start
+        return self.jobs
+
+    def summary(self):
+        ok = sum(1 for job in self.jobs if job.status == 'ok')
+        rate = len(self.jobs) / self.elapsed if self.elapsed else 0.0
+        return {'total': len(self.jobs), 'ok': ok,
+                'failed': len(self.jobs) - ok,
+                'elapsed': round(self.elapsed, 3),
+                'jobs_per_second': round(rate, 2),
+                'workers': self.workers}
+
+
+def write_report(path, jobs, summary):
+    """Write per-job results to path, as JSON or CSV depending on extension"""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if path.lower().endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump({'summary': summary,
+                       'results': [job.as_dict() for job in jobs]},
+                      f, indent=2, sort_keys=True)
+        return
+
+    if sys.version_info[0] < 3:
+        f = open(path, 'wb')
+    else:
+        f = open(path, 'w', newline='')
+    with f:
+        writer = csv.DictWriter(f, REPORT_FIELDS)
+        writer.writeheader()
+        for job in jobs:
+            writer.writerow(job.as_dict())
+
+
+def local_identifiers():
+    """This machine's serial number and en0 MAC address, if available"""
+    serial = mac = ''
+    devnull = open(os.devnull, 'w')
+    try:
+        out = subprocess.Popen(['ioreg', '-rd1', '-c', 'IOPlatformExpertDevice'],
+                               stdout=subprocess.PIPE,
+                               stderr=devnull).communicate()[0]
+        match = re.search(r'"IOPlatformSerialNumber" = "([^"]+)"',
+                          out.decode('utf-8', 'replace'))
+        if match:
+            serial = match.group(1).upper()
+    except OSError:
+        pass
+    try:
+        out = subprocess.Popen(['ifconfig', 'en0'], stdout=subprocess.PIPE,
+                               stderr=devnull).communicate()[0]
+        match = re.search(r'ether ([0-9a-f:]{17})', out.decode('utf-8', 'replace'))
+        if match:
+            mac = normalize_mac(match.group(1))
+    except OSError:
+        pass
+    devnull.close()
+    return serial, mac
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('manifest', help="CSV or JSON manifest of serial/MAC to CPU number")
+    parser.add_argument('-r', '--report', default=REPORT,
+                        help="where to write results, .json or .csv (default %(default)s)")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="jobs to run at once (default 8)")
+    parser.add_argument('--retries', type=int, default=2,
+                        help="extra attempts per failed job (default 2)")
+    parser.add_argument('--timeout', type=float, default=300,
+                        help="seconds before a jamf call is killed (default 300)")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument('--wrapper',
+                       help="command prefix template, e.g. 'ssh admin@{serial}.lab'")
+    where.add_argument('--local', action='store_true',
+                       help="only process this machine's entry")
+    parser.add_argument('--no-recon', action='store_true',
+                        help="skip jamf recon after renaming")
+    args = parser.parse_args(argv)
+
+    try:
+        jobs = read_manifest(args.manifest)
+    except (IOError, ManifestError) as e:
+        print("Can't read manifest: {}".format(e))
+        return 1
+
+    if args.wrapper and jobs:
+        # Catch a bad template here rather than in every worker
+        try:
+            BulkRenamer(jobs, wrapper=args.wrapper).command(jobs[0], [])
+        except (KeyError, IndexError, ValueError) as e:
+            parser.error("bad --wrapper template {!r}: {} {}".format(
+                args.wrapper, type(e).__name__, e))
+
+    if args.local:
+        serial, mac = local_identifiers()
+        jobs = [job for job in jobs
+                if (serial and job.serial == serial) or (mac and job.mac == mac)]
+        if not jobs:
+            print("No manifest entry for this machine ({} / {})".format(serial, mac))
+            return 1
+
+    renamer = BulkRenamer(jobs, workers=args.workers, retries=args.retries,
+                          timeout=args.timeout, wrapper=args.wrapper,
+                          recon=not args.no_recon)
+    print("Renaming {} machine(s) with {} worker(s)".format(len(jobs), renamer.workers))
+    renamer.run()
+    summary = renamer.summary()
+    try:
+        write_report(args.report, jobs, summary)
+    except (IOError, OSError) as e:
+        print("Can't write report: {}".format(e))
+        return 1
+
+    print("{ok}/{total} succeeded in {elapsed}s ({jobs_per_second} jobs/s)".format(**summary))
+    print("Report written to {}".format(args.report))
+    return 0 if summary['failed'] == 0 else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
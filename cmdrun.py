@@ -0,0 +1,265 @@
+#!/usr/bin/python
+"""
+Command Runner
+
+Runs the external commands our scripts depend on (jamf, lpadmin,
+networksetup, launchctl...) and appends a timing record for each one to a
+JSON-lines log, so we can see where a deployment spends its time:
+
+    {"cmd": "jamf recon", "label": "jamf recon", "start": 1500000000.0,
+     "duration": 84.2, "returncode": 0, "stderr": "", "host": "cpu1234", "pid": 812}
+
+From Python, use run() or the drop-in cmdrun.Popen:
+
+    import cmdrun
+    result = cmdrun.run(['jamf', 'recon'], timeout=600)
+    proc = cmdrun.Popen(['jamf', 'recon'], stdout=subprocess.PIPE)
+
+From shell scripts, put it in front of the command. Output passes through
+and the exit code is the command's own:
+
+    /usr/bin/python "/Library/Application Support/UNCA/lib/cmdrun.py" run -- lpadmin -x Lab_Printer
+
+Then, across as many logs as you like (e.g. collected from a lab):
+
+    cmdrun.py summary commands.jsonl other-machine.jsonl
+
+reports count, failures, p50, p95 and max duration per command.
+
+Set CMDRUN_LOG to log somewhere else, or to an empty string to not log.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import math
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+LOGPATH = os.environ.get("CMDRUN_LOG",
+                         "/Library/Application Support/UNCA/logs/commands.jsonl")
+
+# Keep only this much of each command's stderr in the log
+STDERR_LIMIT = 500
+
+
+def label_for(cmd):
+    """'jamf recon', 'lpadmin -x', 'launchctl asuser'... from an argv list"""
+    if cmd[:1] == ['sudo']:
+        cmd = cmd[1:]
+    name = os.path.basename(cmd[0]) if cmd else ''
+    if len(cmd) > 1 and '/' not in cmd[1] and not cmd[1].isdigit():
+        return "{} {}".format(name, cmd[1])
+    return name
+
+
+def record(cmd, start, duration, returncode, stderr=None, label=None, log=None):
+    """Append one timing record; never lets logging break the caller"""
+    path = LOGPATH if log is None else log
+    if not path:
+        return
+    if isinstance(stderr, bytes):
+        stderr = stderr.decode('utf-8', 'replace')
+    entry = {'cmd': ' '.join(cmd), 'label': label or label_for(cmd),
+             'start': round(start, 3), 'duration': round(duration, 3),
+             'returncode': returncode,
+             'stderr': (stderr or '').strip()[-STDERR_LIMIT:],
+             'host': socket.gethostname(), 'pid': os.getpid()}
+    line = (json.dumps(entry, sort_keys=True) + '\n').encode('utf-8')
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # One write() to an O_APPEND file, so concurrent writers don't interleave
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        sys.stderr.write("cmdrun: can't write {}: {}\n".format(path, e))
+
+
+class Popen(subprocess.Popen):
+    """
+    subprocess.Popen that logs a timing record when the process is reaped
+
+    Takes two extra keyword arguments: label (how the command is grouped
+    in summaries) and log (a different log path). stderr is only captured
+    in the record when it's piped and read through communicate().
+    """
+
+    def __init__(self, args, label=None, log=None, **kwargs):
+        if isinstance(args, (bytes, type(u''))):
+            self.cmd = [args]
+        else:
+            self.cmd = list(args)
+        self.label = label
+        self.log = log
+        self.started = time.time()
+        self._recorded = False
+        self._communicating = False
+        try:
+            subprocess.Popen.__init__(self, args, **kwargs)
+        except OSError as e:
+            record(self.cmd, self.started, time.time() - self.started, 127,
+                   str(e), label, log)
+            raise
+
+    def _record(self, stderr=None):
+        if not self._recorded and self.returncode is not None:
+            self._recorded = True
+            record(self.cmd, self.started, time.time() - self.started, self.returncode,
+                   stderr, self.label, self.log)
+
+    def communicate(self, *args, **kwargs):
+        self._communicating = True
+        try:
+            out, err = subprocess.Popen.communicate(self, *args, **kwargs)
+        finally:
+            self._communicating = False
+        self._record(err)
+        return out, err
+
+    def wait(self, *args, **kwargs):
+        returncode = subprocess.Popen.wait(self, *args, **kwargs)
+        if not self._communicating:
+            self._record()
+        return returncode
+
+
+class Result(object):
+    """What run() returns"""
+
+    def __init__(self, returncode, out, err, duration, timed_out):
+        self.returncode = returncode
+        self.out = out
+        self.err = err
+        self.duration = duration
+        self.timed_out = timed_out
+
+
+def run(cmd, timeout=None, label=None, log=None, **kwargs):
+    """
+    Run cmd to completion, capturing its output, and log how long it took.
+
+    If timeout (seconds) passes first the process is killed and
+    Result.timed_out is set. Extra keyword arguments go to Popen.
+    """
+    kwargs.setdefault('stdout', subprocess.PIPE)
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    proc = Popen(cmd, label=label, log=log, **kwargs)
+    expired = []
+
+    def kill():
+        expired.append(True)
+        try:
+            proc.kill()
+        except OSError:
+            pass
+
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        (out, err) = proc.communicate()
+    finally:
+        if timer:
+            # Wait for the timer thread to wind down too; left running
+            # (it's a daemon under a daemon worker) Python 2 prints
+            # tracebacks from it at interpreter shutdown
+            timer.cancel()
+            timer.join()
+    return Result(proc.returncode, out, err, time.time() - proc.started,
+                  bool(expired))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    rank = int(math.ceil(pct / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+
+def summarize(paths):
+    """Per-label stats over every record in the given logs"""
+    durations = {}
+    failures = {}
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                label = entry.get('label') or entry.get('cmd', '?')
+                durations.setdefault(label, []).append(float(entry.get('duration', 0)))
+                if entry.get('returncode') != 0:
+                    failures[label] = failures.get(label, 0) + 1
+
+    rows = []
+    for label, values in durations.items():
+        values.sort()
+        rows.append({'label': label, 'count': len(values),
+                     'failed': failures.get(label, 0),
+                     'p50': percentile(values, 50), 'p95': percentile(values, 95),
+                     'max': values[-1], 'total': sum(values)})
+    rows.sort(key=lambda row: row['total'], reverse=True)
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time external commands")
+    sub = parser.add_subparsers(dest='command')
+    runner = sub.add_parser('run', help="run a command and log its timing")
+    runner.add_argument('--label', help="group it under this name in summaries")
+    runner.add_argument('--timeout', type=float, help="kill it after this many seconds")
+    runner.add_argument('cmd', nargs=argparse.REMAINDER,
+                        help="the command, after --")
+    summary = sub.add_parser('summary', help="p50/p95 per command across logs")
+    summary.add_argument('logs', nargs='*', help="JSON-lines logs (default: {})".format(LOGPATH))
+    summary.add_argument('--json', action='store_true', help="print JSON instead of a table")
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+        if not cmd:
+            parser.error("no command given")
+        try:
+            # stdout goes straight through; stderr is captured for the log
+            # and then passed on
+            result = run(cmd, timeout=args.timeout, label=args.label, stdout=None)
+        except OSError as e:
+            sys.stderr.write("{}: {}\n".format(cmd[0], e))
+            return 127
+        if result.err:
+            err = result.err
+            if not isinstance(err, str):
+                err = err.decode('utf-8', 'replace')
+            sys.stderr.write(err)
+        return result.returncode if result.returncode >= 0 else 128 - result.returncode
+
+    if args.command == 'summary':
+        rows = summarize(args.logs or [LOGPATH])
+        if args.json:
+            print(json.dumps(rows, indent=2, sort_keys=True))
+            return 0
+        print("{:<40} {:>6} {:>6} {:>9} {:>9} {:>9} {:>10}".format(
+            'command', 'count', 'failed', 'p50 s', 'p95 s', 'max s', 'total s'))
+        for row in rows:
+            print("{label:<40} {count:>6} {failed:>6} {p50:>9.2f} {p95:>9.2f} "
+                  "{max:>9.2f} {total:>10.1f}".format(**row))
+        return 0
+
+    parser.print_help()
+    return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/python
+"""
+Command Stream
+
+Runs a command and reads its output line by line as it's produced,
+instead of holding all of it until the process exits. Only the last
+`tail` lines are kept, in a ring buffer, so a chatty `jamf recon -verbose`
+can't grow without bound, and the pipe is always drained so a child can
+never wedge on a full pipe.
+
+Lines go through a small generator pipeline:
+
+    read_lines()  raw output, plus a None tick every second or so
+    phases()      known recon phases ("Locating applications...",
+                  "Submitting data to...") become ('phase', name) events
+    Stream.events() adds the watchdog: if the child prints nothing at all
+                  for the current phase's timeout it's taken to be
+                  wedged, killed, and ('stalled', name) is reported
+
+    import cmdstream
+    stream = cmdstream.Stream(['jamf', 'recon'], phase_timeout=300)
+    for kind, value in stream.events():
+        if kind == 'phase':
+            print("Now: " + value)
+    stream.returncode, stream.stalled, list(stream.tail)
+
+From a shell script, for timestamped progress in the policy log:
+
+    /usr/bin/python "/Library/Application Support/UNCA/lib/cmdstream.py" --phase-timeout 300 -- jamf recon
+
+Each run is also recorded through cmdrun.py, with the tail as its stderr.
+"""
+
+from __future__ import print_function
+
+import argparse
+import collections
+import errno
+import os
+import re
+import select
+import signal
+import subprocess
+import sys
+import time
+
+import cmdrun
+
+# jamf recon's progress lines, e.g. "Locating applications..." or
+# "Submitting data to https://jss.example.com:8443/...", plus reconbroker's
+# "Waiting for the recon lock..." and "Running ... recon"
+PHASE_RE = re.compile(r'^(Retrieving|Locating|Gathering|Finding|Searching|Submitting|Checking'
+                      r'|Waiting|Running)\b')
+
+# Longest a line can get before it's passed on anyway
+MAX_LINE = 64 * 1024
+
+
+def read_lines(proc, tick=1.0):
+    """
+    Yield proc's output a line at a time as it arrives
+
+    Yields None whenever tick seconds pass with nothing to read, so
+    consumers can check their clocks. Stops at EOF, or once the process
+    has exited and nothing more is coming (a leftover grandchild may still
+    hold the pipe open).
+    """
+    fd = proc.stdout.fileno()
+    pending = b''
+    while True:
+        try:
+            ready = select.select([fd], [], [], tick)[0]
+        except (select.error, OSError) as e:
+            if e.args[0] == errno.EINTR:
+                continue
+            raise
+        if not ready:
+            if proc.poll() is not None:
+                break
+            yield None
+            continue
+        chunk = os.read(fd, 4096)
+        if not chunk:
+            break
+        pending += chunk
+        if b'\n' in chunk:
+            # Split once per chunk; the last piece is an unfinished line
+            lines = pending.split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', 'replace').rstrip('\r')
+        if len(pending) > MAX_LINE:
+            yield pending.decode('utf-8', 'replace')
+            pending = b''
+    if pending:
+        yield pending.decode('utf-8', 'replace').rstrip('\r')
+
+
+def phase_name(line):
+    """'Submitting data to https://...' -> 'Submitting data', or None"""
+    line = line.strip()
+    if not PHASE_RE.match(line):
+        return None
+    name = line.rstrip('.').split(' from ')[0].split(' to ')[0]
+    return name.strip()
+
+
+def phases(lines):
+    """Turn raw lines into ('line', text) and ('phase', name) events"""
+    for line in lines:
+        if line is None:
+            yield ('tick', None)
+            continue
+        yield ('line', line)
+        name = phase_name(line)
+        if name:
+            yield ('phase', name)
+
+
+class Stream(object):
+    """
+    A running command whose output is streamed rather than collected
+
+    phase_timeout is how long (seconds) the child may go without printing
+    anything before it's killed; any line of output resets the clock, so
+    a long phase that is still talking is left alone. timeouts overrides
+    it per phase name, e.g. {'Locating applications': 900}, with 0
+    meaning never. new_group starts the child in its own process group,
+    so killing it also kills anything it started.
+    """
+
+    def __init__(self, cmd, phase_timeout=600, timeouts=None, tail=200,
+                 label=None, new_group=False, **kwargs):
+        self.cmd = list(cmd)
+        self.phase_timeout = phase_timeout
+        self.timeouts = timeouts or {}
+        self.tail = collections.deque(maxlen=tail)
+        self.label = label
+        self.new_group = new_group
+        self.phase = 'starting'
+        self.phases = []
+        self.stalled = False
+        self.returncode = None
+        if new_group:
+            kwargs['preexec_fn'] = os.setpgrp
+        self.started = time.time()
+        try:
+            self.proc = subprocess.Popen(self.cmd, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, **kwargs)
+        except OSError as e:
+            cmdrun.record(self.cmd, self.started, 0, 127, str(e), label)
+            raise
+        self.pid = self.proc.pid
+
+    def kill(self):
+        """Kill the child (and its group, if it has one)"""
+        try:
+            if self.new_group:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            else:
+                self.proc.kill()
+        except OSError:
+            pass
+
+    def events(self):
+        """
+        Yield ('line', text), ('phase', name), ('stalled', name) and
+        finally ('exit', returncode) as the command runs
+        """
+        phase_started = quiet_since = time.time()
+        try:
+            for kind, value in phases(read_lines(self.proc)):
+                now = time.time()
+                if kind == 'line':
+                    quiet_since = now
+                    self.tail.append(value)
+                    yield (kind, value)
+                elif kind == 'phase':
+                    self.phases.append((self.phase, round(now - phase_started, 3)))
+                    self.phase = value
+                    phase_started = now
+                    yield (kind, value)
+                limit = self.timeouts.get(self.phase, self.phase_timeout)
+                if not self.stalled and limit and now - quiet_since > limit:
+                    self.stalled = True
+                    self.tail.append("[killed: no output in '{}' for {}s]".format(
+                        self.phase, limit))
+                    self.kill()
+                    yield ('stalled', self.phase)
+        except GeneratorExit:
+            # Consumer gave up on us; don't leave the child running
+            self.kill()
+            raise
+        finally:
+            self.proc.stdout.close()
+            self.returncode = self.proc.wait()
+            self.phases.append((self.phase, round(time.time() - phase_started, 3)))
+            cmdrun.record(self.cmd, self.started, time.time() - self.started,
+                          self.returncode, '\n'.join(self.tail), self.label)
+        yield ('exit', self.returncode)
+
+    def run(self):
+        """Consume the stream without looking at it; returns the exit code"""
+        for _ in self.events():
+            pass
+        return self.returncode
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a command, streaming its progress")
+    parser.add_argument('--phase-timeout', type=float, default=600,
+                        help="kill it if it prints nothing for this long (default %(default)s)")
+    parser.add_argument('--tail', type=int, default=200,
+                        help="lines of output to keep (default %(default)s)")
+    parser.add_argument('--quiet', action='store_true',
+                        help="only print phases, not every line")
+    parser.add_argument('cmd', nargs=argparse.REMAINDER, help="the command, after --")
+    args = parser.parse_args(argv)
+
+    cmd = args.cmd[1:] if args.cmd[:1] == ['--'] else args.cmd
+    if not cmd:
+        parser.error("no command given")
+    try:
+        stream = Stream(cmd, phase_timeout=args.phase_timeout, tail=args.tail,
+                        new_group=True)
+    except OSError as e:
+        sys.stderr.write("{}: {}\n".format(cmd[0], e))
+        return 127
+
+    for kind, value in stream.events():
+        stamp = time.strftime('%H:%M:%S')
+        if kind == 'line' and not args.quiet:
+            print(value)
+        elif kind == 'phase':
+            print("[{}] phase: {}".format(stamp, value))
+        elif kind == 'stalled':
+            print("[{}] no output in '{}', killed".format(stamp, value))
+        sys.stdout.flush()
+
+    for name, took in stream.phases:
+        print("  {:<45} {:8.2f}s".format(name, took))
+    returncode = stream.returncode
+    return returncode if returncode >= 0 else 128 - returncode
+
+if __name__ == '__main__':
+    sys.exit(main())
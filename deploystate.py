@@ -0,0 +1,315 @@
+#!/usr/bin/python
+"""
+Deploy State
+
+Record of every CPU number "Set CPU Number.py" has handed out, and how
+the rename and recon for it went. Lives where deploy.plist was meant to:
+
+    /Library/Application Support/UNCA/db/deploy.log    append-only, one JSON record per line
+    /Library/Application Support/UNCA/db/deploy.index  SQLite index over the log
+
+Each event is one appended line (written and fsync'd under an flock), then
+the rows it touches in the index are updated in a single transaction, so
+nothing is ever rewritten wholesale. The index remembers how much of the
+log it covers; if a write was interrupted between the two steps, the next
+write (or query by a user who can write) replays the missing tail. Queries
+never create files. `reindex` rebuilds the index from scratch.
+
+The index holds the latest state of each step per machine, keyed by CPU
+number, with lookups by hostname and by (step, status).
+
+Queries:
+
+    deploystate.py show cpu1234
+    deploystate.py taken 1234        # exit 0 if already assigned
+    deploystate.py list recon failed
+    deploystate.py reindex
+
+Set DEPLOY_DB to use a different directory.
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import sys
+import time
+
+import sqlite3
+
+DBPATH = os.environ.get("DEPLOY_DB", "/Library/Application Support/UNCA/db")
+
+STEPS = ('rename', 'recon')
+STATES = ('started', 'ok', 'failed', 'cancelled')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS machines (cpu TEXT PRIMARY KEY, hostname TEXT, updated REAL);
+CREATE INDEX IF NOT EXISTS machines_hostname ON machines (hostname);
+CREATE TABLE IF NOT EXISTS steps (cpu TEXT, step TEXT, status TEXT, ts REAL, detail TEXT,
+                                  PRIMARY KEY (cpu, step));
+CREATE INDEX IF NOT EXISTS steps_status ON steps (step, status);
+"""
+
+
+class Unavailable(Exception):
+    """The index exists but can't be read, or is missing and we can't build it"""
+
+
+def cpu_number(name):
+    """'cpu1234', 'CPU 1234' or '1234' -> '1234'"""
+    name = ''.join(str(name).split()).lower()
+    if name.startswith('cpu'):
+        name = name[3:]
+    return name
+
+
+class Store(object):
+    """The deploy log and its index"""
+
+    def __init__(self, path=None):
+        self.path = path or DBPATH
+        self.log_path = os.path.join(self.path, 'deploy.log')
+        self.index_path = os.path.join(self.path, 'deploy.index')
+
+    def _lock(self):
+        """Open the log for appending and take the writer lock on it"""
+        if not os.path.isdir(self.path):
+            try:
+                os.makedirs(self.path)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def _index(self):
+        db = sqlite3.connect(self.index_path)
+        db.executescript(SCHEMA)
+        return db
+
+    def _offset(self, db):
+        row = db.execute("SELECT value FROM meta WHERE key = 'offset'").fetchone()
+        return row[0] if row else 0
+
+    def _apply(self, db, record):
+        """Fold one log record into the index"""
+        cpu = record['cpu']
+        db.execute("INSERT OR IGNORE INTO machines (cpu) VALUES (?)", (cpu,))
+        if record.get('hostname'):
+            db.execute("UPDATE machines SET hostname = ? WHERE cpu = ?",
+                       (record['hostname'], cpu))
+        db.execute("UPDATE machines SET updated = ? WHERE cpu = ?",
+                   (record['ts'], cpu))
+        db.execute("INSERT OR REPLACE INTO steps (cpu, step, status, ts, detail)"
+                   " VALUES (?, ?, ?, ?, ?)",
+                   (cpu, record['step'], record['status'], record['ts'],
+                    record.get('detail', '')))
+
+    def _catch_up(self, db):
+        """Replay any part of the log the index hasn't seen yet"""
+        offset = self._offset(db)
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            return
+        if size <= offset:
+            return
+        with open(self.log_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                offset += len(line)
+                try:
+                    self._apply(db, json.loads(line.decode('utf-8')))
+                except (ValueError, KeyError):
+                    print("Skipping bad record at {}".format(offset - len(line)))
+        db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('offset', ?)",
+                   (offset,))
+
+    def record(self, cpu, step, status, hostname=None, detail=''):
+        """Append one event and update the index for it"""
+        if step not in STEPS:
+            raise ValueError("unknown step {!r}".format(step))
+        if status not in STATES:
+            raise ValueError("unknown status {!r}".format(status))
+        record = {'ts': round(time.time(), 3), 'cpu': cpu_number(cpu),
+                  'step': step, 'status': status}
+        if hostname:
+            record['hostname'] = hostname.strip().lower()
+        if detail:
+            record['detail'] = detail[-500:]
+        line = (json.dumps(record, sort_keys=True) + '\n').encode('utf-8')
+
+        fd = self._lock()
+        try:
+            db = self._index()
+            try:
+                with db:
+                    self._catch_up(db)
+                    os.write(fd, line)
+                    os.fsync(fd)
+                    self._apply(db, record)
+                    db.execute("INSERT OR REPLACE INTO meta (key, value)"
+                               " VALUES ('offset', ?)", (os.fstat(fd).st_size,))
+            finally:
+                db.close()
+        finally:
+            self._unlock(fd)
+        return record
+
+    def _writable(self):
+        """True if this user could take the writer lock and update the index"""
+        index = self.index_path if os.path.exists(self.index_path) else self.path
+        return os.access(self.log_path, os.W_OK) and os.access(index, os.W_OK)
+
+    def _reader(self):
+        """Open the index for a query, or None if nothing has been recorded.
+
+        Queries never create anything. The writer lock is only taken when
+        the log has moved past the index and this user can write both.
+        """
+        try:
+            size = os.path.getsize(self.log_path)
+        except OSError:
+            size = None
+        offset = None
+        if os.path.exists(self.index_path):
+            db = sqlite3.connect(self.index_path)
+            try:
+                offset = self._offset(db)
+            except sqlite3.Error:
+                pass
+            if offset is not None and (size is None or size <= offset):
+                return db
+            db.close()
+        if size is None:
+            if offset is None and os.path.exists(self.index_path):
+                raise Unavailable("{} is not a deploy index".format(self.index_path))
+            return None
+        if not self._writable():
+            if offset is None:
+                raise Unavailable("{} has not been indexed; run reindex as root"
+                                  .format(self.log_path))
+            # Read-only user: answer from the index as it stands
+            return sqlite3.connect(self.index_path)
+        fd = self._lock()
+        try:
+            db = self._index()
+            with db:
+                self._catch_up(db)
+        finally:
+            self._unlock(fd)
+        return db
+
+    def lookup(self, name):
+        """Latest state for a CPU number or hostname, or None"""
+        db = self._reader()
+        if db is None:
+            return None
+        try:
+            row = db.execute("SELECT cpu, hostname, updated FROM machines"
+                             " WHERE hostname = ? OR cpu = ? LIMIT 1",
+                             (str(name).strip().lower(), cpu_number(name))).fetchone()
+            if row is None:
+                return None
+            entry = {'cpu': row[0], 'hostname': row[1], 'updated': row[2],
+                     'steps': {}}
+            for step, status, ts, detail in db.execute(
+                    "SELECT step, status, ts, detail FROM steps WHERE cpu = ?",
+                    (row[0],)):
+                entry['steps'][step] = {'status': status, 'ts': ts,
+                                        'detail': detail}
+            return entry
+        except sqlite3.Error as e:
+            raise Unavailable("{}: {}".format(self.index_path, e))
+        finally:
+            db.close()
+
+    def taken(self, name):
+        """True if that CPU number (or hostname) has been assigned before"""
+        entry = self.lookup(name)
+        return bool(entry and entry['steps'].get('rename', {}).get('status') == 'ok')
+
+    def members(self, step, status):
+        """CPU numbers whose step is currently in status"""
+        db = self._reader()
+        if db is None:
+            return []
+        try:
+            return [row[0] for row in db.execute(
+                "SELECT cpu FROM steps WHERE step = ? AND status = ? ORDER BY ts",
+                (step, status))]
+        except sqlite3.Error as e:
+            raise Unavailable("{}: {}".format(self.index_path, e))
+        finally:
+            db.close()
+
+    def reindex(self):
+        """Throw the index away and rebuild it from the log"""
+        fd = self._lock()
+        try:
+            if os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            db = self._index()
+            try:
+                with db:
+                    self._catch_up(db)
+                return self._offset(db)
+            finally:
+                db.close()
+        finally:
+            self._unlock(fd)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the CPU-number deploy log")
+    sub = parser.add_subparsers(dest='command')
+    show = sub.add_parser('show', help="latest state of a machine")
+    show.add_argument('name', help="CPU number or hostname")
+    taken = sub.add_parser('taken', help="exit 0 if a CPU number is already assigned")
+    taken.add_argument('name', help="CPU number or hostname")
+    members = sub.add_parser('list', help="machines whose step is in a state")
+    members.add_argument('step', choices=STEPS)
+    members.add_argument('status', choices=STATES)
+    sub.add_parser('reindex', help="rebuild the index from the log")
+    args = parser.parse_args(argv)
+
+    store = Store()
+    try:
+        if args.command == 'show':
+            entry = store.lookup(args.name)
+            if entry is None:
+                print("No record of {}".format(args.name))
+                return 1
+            print(json.dumps(entry, indent=2, sort_keys=True))
+        elif args.command == 'taken':
+            if store.taken(args.name):
+                print("cpu{} is taken".format(cpu_number(args.name)))
+                return 0
+            print("cpu{} is free".format(cpu_number(args.name)))
+            return 1
+        elif args.command == 'list':
+            for cpu in store.members(args.step, args.status):
+                print("cpu{}".format(cpu))
+        elif args.command == 'reindex':
+            print("Indexed {} bytes of log".format(store.reindex()))
+        else:
+            parser.print_help()
+            return 2
+    except Unavailable as e:
+        print("Deploy log unavailable: {}".format(e), file=sys.stderr)
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+"""
+Inventory
+
+Local snapshot of the fleet's computer names, so "Set CPU Number.py" can
+spot a CPU number that's already in use before it renames anything.
+
+The snapshot is built from an inventory export (a Jamf advanced computer
+search saved as CSV, or JSON) dropped at EXPORT by a policy, and kept in
+an indexed SQLite cache keyed by computer name. Lookups are read-only and
+go straight to the index; the cache is in WAL mode, so they don't wait on
+a refresh that is rewriting it. Refreshing is left to refresh() (run in
+the background by "Set CPU Number.py", or from the CLI). Once the
+snapshot is older than TTL the export is checked again:
+
+    unchanged           just restamp the cache
+    CSV that only grew  index the new rows only (the bytes already indexed
+                        must hash the same as last time)
+    anything else       rebuild the cache
+
+CSV/JSON fields are matched loosely: "Computer Name"/"name"/"hostname"
+and "Serial Number"/"serial".
+
+    inventory.py check cpu1234 [--no-refresh]
+    inventory.py refresh [--force]
+    inventory.py stats
+
+Set INVENTORY_EXPORT and INVENTORY_CACHE to use other paths.
+"""
+
+from __future__ import print_function
+
+import argparse
+import csv
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+
+EXPORT = os.environ.get("INVENTORY_EXPORT",
+                        "/Library/Application Support/UNCA/inventory/computers.csv")
+CACHE = os.environ.get("INVENTORY_CACHE",
+                       "/Library/Application Support/UNCA/db/inventory.index")
+
+# Seconds before the export is looked at again
+TTL = 3600
+
+# Longest a lookup waits on a locked cache before giving up
+LOOKUP_TIMEOUT = 0.5
+
+NAME_FIELDS = ('computer name', 'computer_name', 'name', 'hostname')
+SERIAL_FIELDS = ('serial number', 'serial_number', 'serial')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE IF NOT EXISTS computers (name TEXT PRIMARY KEY, serial TEXT);
+"""
+
+
+class Unavailable(Exception):
+    """Raised when the cache can't be read, so a name couldn't be checked"""
+
+
+def pick(row, fields):
+    """First non-empty value in row for any of fields (keys lower-cased)"""
+    for field in fields:
+        value = row.get(field)
+        if value:
+            return value.strip()
+    return ''
+
+
+def normalize(row):
+    """(name, serial) from an export row, or None if it has no name"""
+    clean = {}
+    for key, value in row.items():
+        if not key:
+            continue
+        if value is None:
+            value = ''
+        elif isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        elif not isinstance(value, type(u'')):
+            value = str(value)
+        clean[str(key).strip().lower()] = value
+    row = clean
+    name = pick(row, NAME_FIELDS).lower()
+    if not name:
+        return None
+    return name, pick(row, SERIAL_FIELDS).upper()
+
+
+class Snapshot(object):
+    """Cached, indexed copy of the inventory export"""
+
+    def __init__(self, export=None, cache=None, ttl=TTL):
+        self.export = export or EXPORT
+        self.cache = cache or CACHE
+        self.ttl = ttl
+
+    def _connect(self):
+        directory = os.path.dirname(self.cache)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.cache)
+        # Readers see the last committed snapshot while a refresh writes
+        db.execute("PRAGMA journal_mode=WAL")
+        db.executescript(SCHEMA)
+        return db
+
+    @staticmethod
+    def _meta(db):
+        return dict(db.execute("SELECT key, value FROM meta"))
+
+    @staticmethod
+    def _set_meta(db, **values):
+        db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                       values.items())
+
+    def _read_csv(self, offset=0):
+        """
+        Rows of the CSV export from byte offset on
+
+        Also returns the offset read up to, and SHA-1 digests of the bytes
+        before offset and before the new offset, so the next refresh can
+        tell an append from a rewrite. Only whole lines are read; a partly
+        written last line is picked up next time.
+        """
+        sha = hashlib.sha1()
+        with io.open(self.export, 'rb') as f:
+            header = f.readline()
+            f.seek(0)
+            remaining = offset
+            while remaining > 0:
+                chunk = f.read(min(remaining, 1 << 20))
+                if not chunk:
+                    break
+                sha.update(chunk)
+                remaining -= len(chunk)
+            prefix = sha.hexdigest()
+            data = f.read()
+        end = data.rfind(b'\n') + 1
+        text = data[:end]
+        sha.update(text)
+        if offset:
+            text = header + text
+        if sys.version_info[0] >= 3:
+            text = text.decode('utf-8', 'replace')
+        rows = [normalize(row) for row in csv.DictReader(text.splitlines(True))]
+        return [row for row in rows if row], offset + end, prefix, sha.hexdigest()
+
+    def _read_json(self):
+        with open(self.export) as f:
+            data = json.load(f)
+        if isinstance(data, dict):
+            # {"computers": [...]} as well as a bare list
+            data = next((v for v in data.values() if isinstance(v, list)), [])
+        rows = [normalize(row) for row in data if isinstance(row, dict)]
+        return [row for row in rows if row]
+
+    def refresh(self, force=False):
+        """
+        Bring the cache up to date with the export if it's past its TTL.
+
+        Returns what was done: 'fresh', 'unchanged', 'incremental', 'full'
+        or 'missing' (no export to read; the cache is left as it is).
+        """
+        # Without an export there's nothing to build from; don't leave an
+        # empty cache behind for owner() to mistake for "no such names"
+        try:
+            st = os.stat(self.export)
+        except OSError:
+            return 'missing'
+
+        db = self._connect()
+        try:
+            meta = self._meta(db)
+            now = time.time()
+            if not force and now - float(meta.get('refreshed', 0)) < self.ttl:
+                return 'fresh'
+
+            with db:
+                if (not force and meta.get('source') == self.export
+                        and meta.get('mtime') == st.st_mtime
+                        and meta.get('size') == st.st_size):
+                    self._set_meta(db, refreshed=now)
+                    return 'unchanged'
+
+                is_csv = not self.export.lower().endswith('.json')
+                done = 'full'
+                if (is_csv and not force and meta.get('source') == self.export
+                        and st.st_size > int(meta.get('size') or 0)
+                        and meta.get('offset') and meta.get('digest')):
+                    # Only treat it as appended to if every byte indexed
+                    # last time is unchanged; a regenerated export can
+                    # differ anywhere, even at the same length
+                    rows, offset, prefix, digest = self._read_csv(int(meta['offset']))
+                    if prefix == meta['digest']:
+                        done = 'incremental'
+                if done == 'full':
+                    db.execute("DELETE FROM computers")
+                    db.execute("DELETE FROM meta")
+                    if is_csv:
+                        rows, offset, prefix, digest = self._read_csv()
+                    else:
+                        rows, offset, digest = self._read_json(), st.st_size, ''
+                db.executemany("INSERT OR REPLACE INTO computers (name, serial)"
+                               " VALUES (?, ?)", rows)
+                self._set_meta(db, source=self.export, mtime=st.st_mtime,
+                               size=st.st_size, offset=offset, refreshed=now,
+                               digest=digest)
+            return done
+        finally:
+            db.close()
+
+    def owner(self, hostname):
+        """
+        Serial number of the computer already called hostname.
+
+        Returns '' if it's in the inventory without a serial, or None if
+        nothing has that name. Only reads the cache as it stands; raises
+        Unavailable if it has never been built from an export or can't be
+        read.
+        """
+        if not os.path.isfile(self.cache):
+            raise Unavailable("no inventory cache at {}".format(self.cache))
+        try:
+            db = sqlite3.connect(self.cache, timeout=LOOKUP_TIMEOUT)
+            try:
+                built = db.execute("SELECT COUNT(*) FROM meta WHERE key IN"
+                                   " ('source', 'refreshed')").fetchone()[0]
+                if built < 2:
+                    raise Unavailable("inventory cache at {} has never been built".format(
+                        self.cache))
+                row = db.execute("SELECT serial FROM computers WHERE name = ?",
+                                 (hostname.strip().lower(),)).fetchone()
+            finally:
+                db.close()
+        except sqlite3.Error as e:
+            raise Unavailable(str(e))
+        return None if row is None else row[0]
+
+    def stats(self):
+        db = self._connect()
+        try:
+            meta = self._meta(db)
+            meta.pop('digest', None)
+            meta['computers'] = db.execute("SELECT COUNT(*) FROM computers").fetchone()[0]
+            return meta
+        finally:
+            db.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cached fleet inventory lookups")
+    sub = parser.add_subparsers(dest='command')
+    check = sub.add_parser('check', help="exit 1 if a computer name is in use")
+    check.add_argument('hostname')
+    check.add_argument('--no-refresh', action='store_true',
+                       help="don't bring the cache up to date first")
+    refresh = sub.add_parser('refresh', help="update the cache from the export")
+    refresh.add_argument('--force', action='store_true', help="rebuild even if fresh")
+    sub.add_parser('stats', help="show what the cache holds")
+    args = parser.parse_args(argv)
+
+    snapshot = Snapshot()
+    if args.command == 'check':
+        if not args.no_refresh:
+            try:
+                snapshot.refresh()
+            except (IOError, OSError, ValueError, csv.Error, sqlite3.Error) as e:
+                print("Couldn't refresh inventory: {}".format(e))
+        start = time.time()
+        try:
+            serial = snapshot.owner(args.hostname)
+        except Unavailable as e:
+            print("Can't check {}: {}".format(args.hostname, e))
+            return 2
+        took = (time.time() - start) * 1000
+        if serial is None:
+            print("{} is free ({:.1f} ms)".format(args.hostname, took))
+            return 0
+        print("{} is in use by {} ({:.1f} ms)".format(args.hostname, serial or 'unknown serial', took))
+        return 1
+    elif args.command == 'refresh':
+        print(snapshot.refresh(force=args.force))
+    elif args.command == 'stats':
+        print(json.dumps(snapshot.stats(), indent=2, sort_keys=True))
+    else:
+        parser.print_help()
+        return 2
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+#!/usr/bin/python
+"""
+Printer Cleanup
+
+Removes print queues left behind on shared machines, several at a time.
+Replaces the lpstat | cut | xargs lpadmin pipeline in
+"Remove All Printers.sh", which deleted one queue at a time and also fed
+lpstat's status lines to lpadmin as if they were queue names.
+
+Queue names come from `lpstat -e` (one per line), falling back to the
+"printer NAME ..." lines of `lpstat -p` on older CUPS. Each queue is
+deleted with `lpadmin -x` through a bounded pool of workers, timed via
+cmdrun.py.
+
+    printercleanup.py                         remove everything
+    printercleanup.py --keep 'Library_*'      ...except matching queues
+    printercleanup.py --only 'Lab_*' -n       show what would go
+
+Patterns are shell-style and case-sensitive. Set LPSTAT/LPADMIN to use
+other binaries, e.g. stubs/lpstat and stubs/lpadmin on Linux.
+"""
+
+from __future__ import print_function
+
+import argparse
+import fnmatch
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import cmdrun
+
+LPSTAT = os.environ.get("LPSTAT", "/usr/bin/lpstat")
+LPADMIN = os.environ.get("LPADMIN", "/usr/sbin/lpadmin")
+
+# lpstat's messages are localized; the -p parsing below needs English
+LPENV = dict(os.environ, LC_ALL='C', LANG='C')
+
+
+def parse_lpstat_e(text):
+    """Queue names from `lpstat -e` output, minus lpoptions instances"""
+    names = []
+    for line in text.splitlines():
+        name = line.strip().split('/')[0]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+
+def parse_lpstat_p(text):
+    """
+    Queue names from `lpstat -p` output
+
+    Only "printer NAME is idle..."/"printer NAME disabled since..." lines
+    name a queue; the indented status and description lines under each
+    one don't.
+    """
+    names = []
+    for line in text.splitlines():
+        fields = line.split()
+        if len(fields) >= 2 and fields[0] == 'printer' and not line[0].isspace():
+            if fields[1] not in names:
+                names.append(fields[1])
+    return names
+
+
+def _output(result):
+    out = result.out or b''
+    if isinstance(out, bytes):
+        out = out.decode('utf-8', 'replace')
+    return out
+
+
+def list_queues():
+    """Names of all installed print queues"""
+    result = cmdrun.run([LPSTAT, '-e'], timeout=30, env=LPENV)
+    if result.returncode == 0:
+        return parse_lpstat_e(_output(result))
+    result = cmdrun.run([LPSTAT, '-p'], timeout=30, env=LPENV)
+    # lpstat exits 1 with "No destinations added." when there's nothing
+    return parse_lpstat_p(_output(result))
+
+
+def choose(names, only=None, keep=None):
+    """Names matching any `only` pattern (if given) and no `keep` pattern"""
+    chosen = []
+    for name in names:
+        if only and not any(fnmatch.fnmatchcase(name, p) for p in only):
+            continue
+        if keep and any(fnmatch.fnmatchcase(name, p) for p in keep):
+            continue
+        chosen.append(name)
+    return chosen
+
+
+def remove(names, workers=8, timeout=60, dry_run=False):
+    """
+    Delete queues concurrently; returns a result dict per queue
+
+    Results have name, status ('removed', 'failed' or 'dry-run'),
+    duration and error.
+    """
+    results = [{'name': name, 'status': 'pending', 'duration': 0.0, 'error': ''}
+               for name in names]
+    if dry_run:
+        for result in results:
+            result['status'] = 'dry-run'
+        return results
+
+    pending = queue.Queue()
+    for result in results:
+        pending.put(result)
+
+    def worker():
+        while True:
+            try:
+                result = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                run = cmdrun.run([LPADMIN, '-x', result['name']], timeout=timeout,
+                                 env=LPENV)
+            except OSError as e:
+                result.update(status='failed', error=str(e))
+                continue
+            result['duration'] = round(run.duration, 3)
+            if run.returncode == 0:
+                result['status'] = 'removed'
+            else:
+                err = run.err or b''
+                if isinstance(err, bytes):
+                    err = err.decode('utf-8', 'replace')
+                if run.timed_out:
+                    err = "timed out after {}s".format(timeout)
+                result.update(status='failed', error=err.strip())
+
+    threads = [threading.Thread(target=worker)
+               for _ in range(min(max(1, workers), len(results)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        while t.is_alive():
+            t.join(0.5)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remove print queues in parallel")
+    parser.add_argument('--only', action='append', metavar='PATTERN',
+                        help="only remove queues matching this (repeatable)")
+    parser.add_argument('--keep', action='append', metavar='PATTERN',
+                        help="never remove queues matching this (repeatable)")
+    parser.add_argument('-n', '--dry-run', action='store_true',
+                        help="list what would be removed without removing it")
+    parser.add_argument('-w', '--workers', type=int, default=8,
+                        help="lpadmin processes to run at once (default %(default)s)")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="seconds before an lpadmin is killed (default %(default)s)")
+    parser.add_argument('--json', action='store_true',
+                        help="print the per-queue report as JSON")
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    try:
+        names = list_queues()
+    except OSError as e:
+        print("Can't run {}: {}".format(LPSTAT, e))
+        return 1
+    chosen = choose(names, args.only, args.keep)
+    results = remove(chosen, workers=args.workers, timeout=args.timeout,
+                     dry_run=args.dry_run)
+    elapsed = time.time() - start
+    failed = [r for r in results if r['status'] == 'failed']
+
+    if args.json:
+        print(json.dumps({'found': len(names), 'selected': len(chosen),
+                          'failed': len(failed), 'elapsed': round(elapsed, 3),
+                          'results': results}, indent=2, sort_keys=True))
+    else:
+        for r in results:
+            print("{:<8} {:<40} {:6.2f}s {}".format(r['status'], r['name'],
+                                                   r['duration'], r['error']))
+        print("{} queue(s) found, {} selected, {} failed, {:.2f}s".format(
+            len(names), len(chosen), len(failed), elapsed))
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+#!/usr/bin/python
+"""
+Recon Broker
+
+Call this instead of running `jamf recon` directly. Requests made close
+together are coalesced into a single inventory upload, and a lock makes
+sure two policies never run recon at the same time.
+
+How it works: every request stamps the time it was made into a shared
+state file, then queues for the recon lock. Whoever holds the lock waits
+until no new request has come in for --window seconds (the debounce,
+capped at --max-delay), runs recon once and records when it started.
+Anyone still queued behind it whose request is older than that start time
+has been served by that run and just returns its result.
+
+Shell scripts:
+
+    /usr/bin/python "/Library/Application Support/UNCA/lib/reconbroker.py" --no-wait
+
+Someone waiting on the result interactively should pass a short --window
+(e.g. 1); the default suits fire-and-forget callers in a policy chain.
+
+Python:
+
+    import reconbroker
+    returncode = reconbroker.request()              # wait for the result
+    reconbroker.request(wait=False)                 # fire and forget
+
+Set RECON_BROKER_DIR to keep the lock/state somewhere else (e.g. when
+testing with JAMF=stubs/jamf on Linux).
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import time
+
+import cmdrun
+
+# Path to Jamf binary
+JAMF = os.environ.get("JAMF", "/usr/local/bin/jamf")
+
+STATEDIR = os.environ.get("RECON_BROKER_DIR",
+                          "/Library/Application Support/UNCA/recon")
+
+# Seconds of quiet to wait for before running, and the most a request can
+# be held back by a steady stream of newer ones
+WINDOW = 10.0
+MAX_DELAY = 60.0
+
+# Printed while queued for the lock, and while debouncing, so anyone
+# watching our output (cmdstream's watchdog, the GUI's status line) can
+# tell waiting from a stuck recon
+WAITING = "Waiting for the recon lock"
+DEBOUNCING = "Waiting for other recon requests"
+
+
+class Timeout(Exception):
+    """Raised when a waiting caller gives up on the recon lock"""
+
+
+class FileLock(object):
+    """Exclusive flock() on a file; released automatically if we die"""
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def acquire(self, timeout=None):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return self
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if deadline is not None and time.time() >= deadline:
+                os.close(self.fd)
+                self.fd = None
+                raise Timeout("timed out waiting for {}".format(self.path))
+            time.sleep(0.2)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if self.fd is None:
+            self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class Broker(object):
+    """Shared recon state kept in statedir"""
+
+    def __init__(self, statedir=None):
+        self.statedir = statedir or STATEDIR
+        self.state_path = os.path.join(self.statedir, 'state.json')
+        self.recon_lock = os.path.join(self.statedir, 'recon.lock')
+        self.state_lock = os.path.join(self.statedir, 'state.lock')
+
+    def setup(self):
+        if not os.path.isdir(self.statedir):
+            try:
+                os.makedirs(self.statedir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def read(self):
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def update(self, **changes):
+        """Read-modify-write the state file under the (short) state lock"""
+        with FileLock(self.state_lock):
+            state = self.read()
+            if 'last_request' in changes:
+                changes['last_request'] = max(changes['last_request'],
+                                              state.get('last_request', 0))
+            state.update(changes)
+            tmp = self.state_path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp, self.state_path)
+            return state
+
+    def request(self, window=WINDOW, max_delay=MAX_DELAY, timeout=None):
+        """
+        Ask for a recon and block until one that started after now finishes.
+
+        Returns recon's exit code. Raises Timeout if timeout seconds pass
+        before the lock comes free.
+        """
+        self.setup()
+        requested = time.time()
+        self.update(last_request=requested)
+
+        print(WAITING + "...")
+        sys.stdout.flush()
+        with FileLock(self.recon_lock).acquire(timeout):
+            state = self.read()
+            if state.get('last_start', 0) >= requested:
+                print("Coalesced into recon started at {}".format(
+                    time.ctime(state['last_start'])))
+                sys.stdout.flush()
+                return state.get('last_rc', 0)
+
+            # Debounce: hold off while other requests keep arriving
+            deadline = requested + max_delay
+            announced = False
+            while True:
+                now = time.time()
+                quiet = self.read().get('last_request', requested) + window - now
+                if quiet <= 0 or now >= deadline:
+                    break
+                if not announced:
+                    print(DEBOUNCING + "...")
+                    sys.stdout.flush()
+                    announced = True
+                time.sleep(min(quiet, deadline - now))
+
+            start = time.time()
+            print("Running {} recon".format(JAMF))
+            sys.stdout.flush()
+            try:
+                returncode = cmdrun.Popen([JAMF, 'recon'], label='jamf recon').wait()
+            except OSError as e:
+                print("Couldn't run recon: {}".format(e))
+                returncode = 127
+            self.update(last_start=start, last_end=time.time(),
+                        last_rc=returncode)
+            return returncode
+
+    def spawn(self, window=WINDOW, max_delay=MAX_DELAY):
+        """Queue a request in a detached process and return straight away"""
+        self.setup()
+        log = open(os.path.join(self.statedir, 'broker.log'), 'a')
+        env = dict(os.environ, JAMF=JAMF, RECON_BROKER_DIR=self.statedir)
+        subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                          '--window', str(window), '--max-delay', str(max_delay)],
+                         stdin=open(os.devnull), stdout=log, stderr=log,
+                         close_fds=True, preexec_fn=os.setsid, env=env)
+        log.close()
+
+
+def request(wait=True, window=WINDOW, max_delay=MAX_DELAY, timeout=None,
+            statedir=None):
+    """
+    Request a recon through the broker.
+
+    With wait=True, returns the exit code of the recon that covered this
+    request. With wait=False, hands the request to a background process
+    and returns None immediately.
+    """
+    broker = Broker(statedir)
+    if not wait:
+        broker.spawn(window, max_delay)
+        return None
+    return broker.request(window, max_delay, timeout)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Coalesce jamf recon requests")
+    parser.add_argument('--no-wait', action='store_true',
+                        help="queue the request and exit immediately")
+    parser.add_argument('--window', type=float, default=WINDOW,
+                        help="seconds of quiet before recon runs (default %(default)s)")
+    parser.add_argument('--max-delay', type=float, default=MAX_DELAY,
+                        help="longest a request is held back (default %(default)s)")
+    parser.add_argument('--timeout', type=float,
+                        help="give up waiting for the lock after this many seconds")
+    parser.add_argument('--status', action='store_true',
+                        help="print the last recon's details and exit")
+    args = parser.parse_args(argv)
+
+    if args.status:
+        print(json.dumps(Broker().read(), indent=2, sort_keys=True))
+        return 0
+
+    if args.no_wait:
+        request(wait=False, window=args.window, max_delay=args.max_delay)
+        print("Recon queued")
+        return 0
+
+    try:
+        returncode = request(window=args.window, max_delay=args.max_delay,
+                             timeout=args.timeout)
+    except Timeout as e:
+        print("Recon not run: {}".format(e))
+        return 1
+    if returncode == 0:
+        print("Submitted inventory to JSS")
+    else:
+        print("Inventory update failed!")
+    return returncode
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,197 @@
+#!/usr/bin/python
+"""
+Session Context
+
+Works out who is at the console, their UID, the macOS version and the
+computer's name in one pass, without starting any other processes, and
+caches the answer in a small file for the next script that asks.
+
+    console user  owner of /dev/console (root at the login window -> "")
+    UID           from the same stat()
+    OS version    ProductVersion in SystemVersion.plist
+    hostname      gethostname()
+
+The cache is thrown away when the console user changes (one stat() to
+check) or after TTL seconds.
+
+Shell scripts load everything with one call (-S skips site-packages,
+which this doesn't need, for a quicker start):
+
+    eval "$(/usr/bin/python -S "/Library/Application Support/UNCA/lib/sessionctx.py" --shell)"
+    echo "$CURRENT_USER $USER_ID $OS_MAJOR.$OS_MINOR $COMPUTER_NAME"
+
+Python:
+
+    import sessionctx
+    ctx = sessionctx.context()      # all values are strings
+
+Only os, sys and time are imported up front, and the cache is plain
+key=value lines, so a cache hit costs little more than starting Python.
+
+Set SESSIONCTX_CONSOLE, SESSIONCTX_SYSTEM_VERSION and SESSIONCTX_CACHE to
+point the probes and cache elsewhere (see benchmarks/session_probe.py).
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+CONSOLE = os.environ.get("SESSIONCTX_CONSOLE", "/dev/console")
+SYSTEM_VERSION = os.environ.get("SESSIONCTX_SYSTEM_VERSION",
+                                "/System/Library/CoreServices/SystemVersion.plist")
+CACHE = os.environ.get("SESSIONCTX_CACHE",
+                       "/Library/Application Support/UNCA/cache/session.ctx")
+
+# Seconds a cached context is trusted for
+TTL = 300
+
+# Console owners that mean nobody is logged in
+NOBODY = ('root', 'loginwindow', '_mbsetupuser')
+
+SHELL_NAMES = [('CURRENT_USER', 'user'), ('USER_ID', 'uid'),
+               ('OS_MAJOR', 'os_major'), ('OS_MINOR', 'os_minor'),
+               ('OS_VERSION', 'os_version'), ('COMPUTER_NAME', 'hostname')]
+
+USAGE = """usage: sessionctx.py [--shell] [--refresh] [--ttl SECONDS]
+
+Console user, UID, OS version and hostname.
+
+  --shell        print VAR='value' lines for eval in sh
+  --refresh      ignore the cache
+  --ttl SECONDS  how long a cached context is good for (default {})
+""".format(TTL)
+
+
+def console_uid():
+    """UID owning the console as a string, or '' if it can't be read"""
+    try:
+        return str(os.stat(CONSOLE).st_uid)
+    except OSError:
+        return ''
+
+
+def os_version():
+    """ProductVersion from SystemVersion.plist, e.g. '10.12.6'"""
+    import re
+    try:
+        with open(SYSTEM_VERSION) as f:
+            match = re.search(r'<key>ProductVersion</key>\s*<string>([^<]+)</string>',
+                              f.read())
+    except IOError:
+        return ''
+    return match.group(1).strip() if match else ''
+
+
+def probe(uid=None):
+    """Gather a fresh context"""
+    import pwd
+    import socket
+    if uid is None:
+        uid = console_uid()
+    user = ''
+    if uid:
+        try:
+            user = pwd.getpwuid(int(uid)).pw_name
+        except KeyError:
+            user = ''
+    if user in NOBODY:
+        user = ''
+
+    version = os_version()
+    parts = (version.split('.') + ['', ''])[:2]
+    return {'user': user, 'uid': uid if user else '',
+            'console_uid': uid, 'os_version': version,
+            'os_major': parts[0], 'os_minor': parts[1],
+            'hostname': socket.gethostname().split('.')[0],
+            'probed': repr(time.time())}
+
+
+def read_cache(path):
+    """The cached context as a dict, or {} if there isn't a readable one"""
+    try:
+        with open(path) as f:
+            return dict(line.rstrip('\n').split('=', 1) for line in f if '=' in line)
+    except (IOError, ValueError):
+        return {}
+
+
+def write_cache(path, ctx):
+    """Atomically replace the cache; a read-only cache just means probing every time"""
+    try:
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp = "{}.{}".format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            for key in sorted(ctx):
+                f.write("{}={}\n".format(key, str(ctx[key]).replace('\n', ' ')))
+        os.rename(tmp, path)
+    except (IOError, OSError):
+        pass
+
+
+def context(refresh=False, ttl=TTL, cache=None):
+    """
+    The current session context, from the cache when it's still good
+
+    Returns a dict of strings: user, uid, os_version, os_major, os_minor
+    and hostname (plus console_uid and probed, used for invalidation).
+    """
+    path = cache or CACHE
+    uid = console_uid()
+    if not refresh:
+        cached = read_cache(path)
+        try:
+            fresh = time.time() - float(cached.get('probed', 0)) < ttl
+        except ValueError:
+            fresh = False
+        if fresh and cached.get('console_uid') == uid:
+            return cached
+
+    ctx = probe(uid)
+    write_cache(path, ctx)
+    return ctx
+
+
+def shell_quote(value):
+    """Single-quote value for sh"""
+    return "'" + str(value).replace("'", "'\\''") + "'"
+
+
+def main(argv=None):
+    # Parsed by hand: importing argparse would cost more than the probe
+    args = sys.argv[1:] if argv is None else list(argv)
+    shell = refresh = False
+    ttl = TTL
+    while args:
+        arg = args.pop(0)
+        if arg == '--shell':
+            shell = True
+        elif arg == '--refresh':
+            refresh = True
+        elif arg == '--ttl' and args:
+            try:
+                ttl = float(args.pop(0))
+            except ValueError:
+                sys.stderr.write(USAGE)
+                return 2
+        elif arg in ('-h', '--help'):
+            print(USAGE, end='')
+            return 0
+        else:
+            sys.stderr.write(USAGE)
+            return 2
+
+    ctx = context(refresh=refresh, ttl=ttl)
+    if shell:
+        for var, key in SHELL_NAMES:
+            print("{}={}".format(var, shell_quote(ctx.get(key, ''))))
+    else:
+        import json
+        print(json.dumps(ctx, indent=2, sort_keys=True))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())